@@ -0,0 +1,324 @@
+"""
+Load test for the query routes in routers/plex_kg.py.
+
+By default the app is served locally on an in-memory embedded store that
+is seeded with synthetic data, so no Plex server or Fuseki is needed:
+
+    python benchmark.py --concurrency 8 --requests 200
+
+Use --url to run against an app that is already running and seeded.
+Results are saved as JSON, pass a previous file to --compare to see the
+change per route.
+"""
+
+import argparse
+import json
+import random
+import statistics
+import subprocess
+import threading
+import time
+import pandas as pd
+import requests
+import uvicorn
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from fuseki_helpers import (
+    construct_relationships,
+    rebuild_watch_stats,
+    upload_graph,
+)
+from main import app
+from rdf_handler import PlexRDFHandler
+from rdf_stores import EmbeddedStore, set_store
+from routers.plex_kg import router
+from typing import Dict, List, Optional
+
+# filled in for routes with path parameters
+path_params = {"movie_name": "the"}
+
+
+def synthetic_datasets(
+    movies: int = 1000,
+    genres: int = 20,
+    persons: int = 3000,
+    plays: int = 5000,
+    seed: int = 0,
+) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame):
+    """
+    Create datasets in the same structure as
+    PlexClient.create_structured_datasets. The same seed always gives the
+    same data.
+
+    Args:
+        movies: int
+        genres: int
+        persons: int
+        plays: int
+        seed: int
+
+    Returns:
+        tuple(genres, persons, media_data, history)
+    """
+    rng = random.Random(seed)
+    words = ["the", "last", "night", "city", "dark", "star", "river", "war"]
+
+    genre_df = pd.DataFrame(
+        [(f"genre-{i}", f"Genre {i}") for i in range(genres)],
+        columns=["slug", "name"],
+    )
+    person_df = pd.DataFrame(
+        [(f"person-{i}", f"Person {i}") for i in range(persons)],
+        columns=["slug", "name"],
+    )
+
+    genre_slugs = list(genre_df["slug"])
+    person_slugs = list(person_df["slug"])
+    movie_df = pd.DataFrame(
+        [
+            {
+                "ratingKey": str(i),
+                "slug": f"movie-{i}",
+                "type": "movie",
+                "title": f"{' '.join(rng.sample(words, 2)).title()} {i}",
+                "rating": round(rng.uniform(1, 10), 1),
+                "originallyAvailableAt": f"{rng.randint(1950, 2024)}-01-01",
+                "duration": rng.randint(80, 180) * 60000,
+                "Genre": rng.sample(genre_slugs, rng.randint(1, 3)),
+                "Director": rng.sample(person_slugs, 1),
+                "Writer": rng.sample(person_slugs, rng.randint(0, 2)),
+                "Role": rng.sample(person_slugs, rng.randint(3, 8)),
+            }
+            for i in range(movies)
+        ]
+    )
+
+    # a few movies get most of the plays, like a real watch history
+    watched = rng.sample(range(movies), max(1, movies // 5))
+    weights = [1 / (rank + 1) for rank in range(len(watched))]
+    history_df = pd.DataFrame(
+        [
+            {
+                "historyKey": f"/status/sessions/history/{i}",
+                "slug": f"movie-{movie}",
+                "viewedAt": 1600000000 + i * 3600,
+            }
+            for i, movie in enumerate(
+                rng.choices(watched, weights=weights, k=plays)
+            )
+        ]
+    )
+
+    return genre_df, person_df, movie_df, history_df
+
+
+def seed_store(datasets: tuple) -> None:
+    """
+    Load datasets into the configured store the same way
+    '/fuseki/data/add' does, without validation.
+
+    Args:
+        datasets: tuple
+            Output of synthetic_datasets.
+    """
+    with open("/app/rdf/ontology.ttl") as f:
+        ontology = f.read()
+    f.close()
+
+    steps = [
+        lambda: upload_graph(PlexRDFHandler().to_ttl(*datasets)),
+        lambda: upload_graph(ontology, "ontology"),
+        construct_relationships,
+        rebuild_watch_stats,
+    ]
+    for step in steps:
+        response = step()
+        if not response.ok:
+            raise RuntimeError(response.text)
+
+
+def query_routes() -> List[str]:
+    """
+    Get the query routes from the Plex KG router. Routes that write data
+    are skipped.
+
+    Returns:
+        List[str]
+    """
+    return [
+        route.path.format(**path_params)
+        for route in router.routes
+        if "GET" in route.methods
+        and route.path.startswith("/fuseki/")
+        and not route.path.startswith("/fuseki/data/")
+    ]
+
+
+def serve_locally(port: int):
+    """
+    Serve the app with uvicorn in a background thread.
+
+    Args:
+        port: int
+
+    Returns:
+        uvicorn.Server
+    """
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    return server
+
+
+def load_route(
+    url: str, total: int, concurrency: int, warmup: int
+) -> Dict:
+    """
+    Send requests to a route from concurrent workers.
+
+    Args:
+        url: str
+        total: int
+            Number of timed requests.
+        concurrency: int
+            Number of requests in flight at the same time.
+        warmup: int
+            Untimed requests sent first.
+
+    Returns:
+        Dict: throughput, latency percentiles in ms and error count.
+    """
+    for _ in range(warmup):
+        requests.get(url, timeout=30)
+
+    def timed_get(_) -> (float, bool):
+        start = time.perf_counter()
+        try:
+            ok = requests.get(url, timeout=30).ok
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed_get, range(total)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency * 1000 for latency, _ in results]
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+
+    return {
+        "requests": total,
+        "errors": sum(1 for _, ok in results if not ok),
+        "throughput": round(total / elapsed, 2),
+        "p50_ms": round(cuts[49], 2),
+        "p95_ms": round(cuts[94], 2),
+        "p99_ms": round(cuts[98], 2),
+    }
+
+
+def compare(results: Dict, baseline: Dict) -> None:
+    """
+    Print the change per route against a previous run.
+
+    Args:
+        results: Dict
+        baseline: Dict
+    """
+    print(f"\nCompared to {baseline['started_at']} ({baseline['commit']})")
+    for route, current in results["routes"].items():
+        previous = baseline["routes"].get(route)
+        if previous is None:
+            print(f"{route:<50} new route")
+            continue
+        changes = [
+            f"{key} {100 * (current[key] / previous[key] - 1):+.1f}%"
+            for key in ["throughput", "p50_ms", "p99_ms"]
+            if previous[key]
+        ]
+        print(f"{route:<50} {', '.join(changes)}")
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--url", help="App URL. Serves locally if unset.")
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--movies", type=int, default=1000)
+    parser.add_argument("--plays", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Defaults to benchmark-<time>.json")
+    parser.add_argument("--compare", help="Previous results file.")
+    args = parser.parse_args()
+
+    started_at = datetime.now(timezone.utc)
+    base_url = args.url
+    if base_url is None:
+        set_store(EmbeddedStore())
+        seed_store(
+            synthetic_datasets(
+                movies=args.movies, plays=args.plays, seed=args.seed
+            )
+        )
+        serve_locally(args.port)
+        base_url = f"http://127.0.0.1:{args.port}"
+
+    results = {
+        "started_at": started_at.isoformat(),
+        "commit": _git_commit(),
+        "url": args.url or "local embedded store",
+        "config": {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "movies": args.movies,
+            "plays": args.plays,
+            "seed": args.seed,
+        },
+        "routes": {},
+    }
+
+    print(f"{'route':<50} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for route in query_routes():
+        stats = load_route(
+            f"{base_url}{route}", args.requests, args.concurrency, args.warmup
+        )
+        results["routes"][route] = stats
+        print(
+            f"{route:<50} {stats['throughput']:>8} {stats['p50_ms']:>8} "
+            f"{stats['p95_ms']:>8} {stats['p99_ms']:>8}"
+            + (f"  errors: {stats['errors']}" if stats["errors"] else "")
+        )
+
+    output = args.output or f"benchmark-{started_at:%Y%m%dT%H%M%S}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    f.close()
+    print(f"\nSaved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+        f.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,23 @@
 import json
-import requests
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
 from pyshacl import validate
-from rdflib import Graph
-from typing import Dict, List
+from rdflib import BNode, Graph, Literal
+from rdflib.namespace import RDF, RDFS, SH, XSD
+from rdf_stores import StoreResponse, UpdateResponse, get_store
+from typing import Callable, Dict, List, Optional
 
 
-base = "http://fuseki:3030/plex"
-headers = {
-    "Accept": "application/json",
-}
+# Queries that are currently running, shared by identical requests
+_in_flight: Dict[tuple, Future] = {}
+_in_flight_lock = threading.Lock()
 
 
 def get_graph(graph_identifier: str = "") -> Graph:
     """
-    Download graph from fuseki.
+    Download graph from the store.
 
     Args:
         graph_identifier: str
@@ -23,45 +27,34 @@ def get_graph(graph_identifier: str = "") -> Graph:
     Returns:
         Graph
     """
-    url = f"{base}/data"
-    if graph_identifier:
-        # Select graph other than default
-        graph_param = f"http://plex-kg/{graph_identifier}"
-    else:
-        graph_param = "default"
-
-    result = requests.get(
-        url,
-        params={"graph": graph_param},
-        headers={**headers, "Accept": "text/turtle"},
-        auth=("admin", "admin"),
-    )
-    result.raise_for_status()
-
-    return Graph().parse(data=result.text, format="turtle")
+    return get_store().get_graph(graph_identifier)
 
 
-def _post(path: str, data: str) -> Dict:
+def _load_query(query_name: str, replacement: str = "") -> str:
     """
-    HTTP POST request template.
+    Read predefined SPARQL query and replace the placeholder if given.
 
     Args:
-        path: str
-            Either /data, /query
-        data: str
-            File content
+        query_name: str
+            Based off of query file, without the extension.
+        replacement: str
 
     Returns:
-        pd.DataFrame: result from request.
+        str
     """
-    url = f"{base}{path}"
-    result = requests.post(url, data=data, headers=headers, timeout=10)
-    result.raise_for_status()
+    query_path = f"/app/rdf/queries/{query_name}.rq"
+    with open(query_path) as f:
+        file_contents = f.read()
+    f.close()
 
-    return json.loads(result.text)
+    if replacement:
+        return file_contents.replace("___replace___", replacement)
+    return file_contents
 
 
-def run_query(query_name: str, replacement: str = "") -> Dict:
+def run_query(
+    query_name: str, replacement: str = "", coalesce: bool = False
+) -> Dict:
     """
     Run predefined SPARQL query.
     If the query supports it, you can replace that area in the query
@@ -71,56 +64,318 @@ def run_query(query_name: str, replacement: str = "") -> Dict:
         query_name: str
             Based off of query file, without the extension.
         replacement: str
+        coalesce: bool
+            Share the result with identical queries that are already
+            running. Only for read routes, since a caller that arrives
+            after an update can get a result from before it.
 
     Returns:
         Dict
     """
-    query_path = f"/app/rdf/queries/{query_name}.rq"
-    with open(query_path) as f:
-        file_contents = f.read()
-    f.close()
-
-    if replacement:
-        query = file_contents.replace("___replace___", replacement)
-    else:
-        query = file_contents
+    query = _load_query(query_name, replacement)
+    if not coalesce:
+        return get_store().query(query)
 
-    data = {"query": query}
-    result = _post("/query", data)
+    result = _single_flight(
+        (query_name, replacement), lambda: get_store().query(query)
+    )
 
     return result
 
 
-def construct_relationships() -> Dict:
+def run_recommendation(query_name: str, seed_query_name: str) -> Dict:
+    """
+    Run a recommendation query with the seed movie picked by a seed
+    subquery, so both run in a single request.
+
+    Args:
+        query_name: str
+            'recommend_unwatched_by_relation' or
+            'recommend_watched_by_relation'.
+        seed_query_name: str
+            Seed subquery file, without the extension.
+
+    Returns:
+        Dict
+    """
+    return run_query(query_name, _load_query(seed_query_name), coalesce=True)
+
+
+def _single_flight(key: tuple, fn: Callable[[], Dict]) -> Dict:
+    """
+    Coalesce concurrent identical calls. The first caller runs fn and the
+    callers that arrive while it's running wait for the same result
+    instead of sending their own request.
+
+    Args:
+        key: tuple
+            Identifies identical calls.
+        fn: Callable[[], Dict]
+
+    Returns:
+        Dict
+    """
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _in_flight[key] = future
+
+    if not is_leader:
+        return future.result()
+
+    try:
+        future.set_result(fn())
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+
+    return future.result()
+
+
+def post_update(update: str) -> UpdateResponse:
+    """
+    Run a SPARQL update.
+
+    Args:
+        update: str
+            SPARQL update string.
+
+    Returns:
+        UpdateResponse
+    """
+    return get_store().update(update)
+
+
+def _join_updates(updates: List[str]) -> str:
+    """
+    Join SPARQL updates into a single request. The prologues are moved to
+    the top since not every store accepts a prologue after ';', so the
+    updates must not redefine a prefix with a different IRI.
+
+    Args:
+        updates: List[str]
+
+    Returns:
+        str
+    """
+    prologue = []
+    operations = []
+    for update in updates:
+        body = []
+        for line in update.strip().splitlines():
+            if line.startswith(("PREFIX ", "BASE ")):
+                if line not in prologue:
+                    prologue.append(line)
+            else:
+                body.append(line)
+        operations.append("\n".join(body).strip())
+
+    return "\n".join(prologue) + "\n\n" + " ;\n\n".join(operations)
+
+
+def run_update(query_name: str, replacement: str = "") -> UpdateResponse:
+    """
+    Run predefined SPARQL update.
+
+    Args:
+        query_name: str
+            Based off of query file, without the extension.
+        replacement: str
+
+    Returns:
+        UpdateResponse
+    """
+    return post_update(_load_query(query_name, replacement))
+
+
+def construct_relationships() -> UpdateResponse:
     """
     Construct relationships on the default graph with Plex data
     using a SPARQL update query.
 
     Returns:
-        Dict
+        UpdateResponse
     """
-    query_path = "/app/rdf/queries/construct_relationships.rq"
-    with open(query_path) as f:
-        file_contents = f.read()
-    f.close()
+    return run_update("construct_relationships")
+
+
+def update_relationships(movie_uris: List[str]) -> UpdateResponse:
+    """
+    Recompute relationships of changed movies only. Candidate pairs are
+    found through the genres and persons the changed movies share, the
+    rest of the relations graph is left as is.
+
+    Args:
+        movie_uris: List[str]
+            Movies that were added, removed or had their genres or
+            persons changed.
 
-    result = requests.post(
-        f"{base}/update",
-        data=file_contents,
-        headers={
-            **headers,
-            "Content-Type": "application/sparql-update",
-        },
-        auth=("admin", "admin"),
-        timeout=10,
+    Returns:
+        UpdateResponse
+    """
+    if not movie_uris:
+        return StoreResponse(204)
+
+    values = " ".join(f"<{uri}>" for uri in movie_uris)
+    return run_update("relations_update", values)
+
+
+def drop_relationships() -> UpdateResponse:
+    """
+    Drop the relations graph, so the next data add rebuilds it in full.
+
+    Returns:
+        UpdateResponse
+    """
+    return run_update("relations_drop")
+
+
+def relations_exist() -> bool:
+    """
+    Returns:
+        bool: whether the relations graph has been built.
+    """
+    return run_query("relations_exist")["boolean"]
+
+
+def get_movie_features() -> Dict[str, frozenset]:
+    """
+    Get the genres and persons of every movie in the store, these are the
+    features relationships are built from.
+
+    Returns:
+        Dict[str, frozenset]: movie -> {(property, value)}
+    """
+    result = run_query("movies_features")
+
+    features = {}
+    for b in result["results"]["bindings"]:
+        features.setdefault(b["movie"]["value"], set()).add(
+            (b["property"]["value"], b["value"]["value"])
+        )
+
+    return {movie: frozenset(f) for movie, f in features.items()}
+
+
+def get_history_watermark(section_id: int, account_id: int) -> int:
+    """
+    Get the viewedAt of the latest play that was ingested.
+
+    Args:
+        section_id: int
+        account_id: int
+
+    Returns:
+        int: Unix timestamp, 0 if nothing was ingested yet.
+    """
+    result = run_query(
+        "history_watermark_get", _ingest_state_uri(section_id, account_id)
     )
+    bindings = result["results"]["bindings"]
+    if not bindings:
+        return 0
 
-    return result
+    return int(bindings[0]["watermark"]["value"])
 
 
-def upload_graph(data: str, name: str = "") -> Dict:
+def set_history_watermark(
+    section_id: int, account_id: int, viewed_at: int
+) -> UpdateResponse:
     """
-    Uoload graph to fuseki.
+    Store the viewedAt of the latest play that was ingested.
+
+    Args:
+        section_id: int
+        account_id: int
+        viewed_at: int
+            Unix timestamp.
+
+    Returns:
+        UpdateResponse
+    """
+    state = _ingest_state_uri(section_id, account_id)
+    return run_update("history_watermark_set", f"({state} {int(viewed_at)})")
+
+
+def rebuild_watch_stats() -> UpdateResponse:
+    """
+    Recompute the 'stats' graph from all watch actions. Used after a full
+    upload of the default graph.
+
+    Returns:
+        UpdateResponse
+    """
+    return run_update("stats_rebuild")
+
+
+def ingest_watch_actions(
+    insert_data: str,
+    stats_rows: str,
+    section_id: int,
+    account_id: int,
+    viewed_at: int,
+) -> UpdateResponse:
+    """
+    Insert new watch actions, add them to the 'stats' graph and move the
+    viewedAt watermark in a single update request so they're applied
+    together.
+
+    Args:
+        insert_data: str
+            INSERT DATA update with the new watch actions.
+        stats_rows: str
+            VALUES rows for the stats_add_plays update.
+        section_id: int
+        account_id: int
+        viewed_at: int
+            Unix timestamp of the latest new play.
+
+    Returns:
+        UpdateResponse
+    """
+    state = _ingest_state_uri(section_id, account_id)
+    operations = [
+        insert_data,
+        _load_query("stats_add_plays", stats_rows),
+        _load_query("history_watermark_set", f"({state} {int(viewed_at)})"),
+    ]
+
+    return post_update(_join_updates(operations))
+
+
+def _ingest_state_uri(section_id: int, account_id: int) -> str:
+    return f"<ingest/history/{section_id}-{account_id}>"
+
+
+def get_movie_slugs(rating_keys: List[str]) -> Dict[str, str]:
+    """
+    Look up movie slugs by Plex ratingKey.
+
+    Args:
+        rating_keys: List[str]
+
+    Returns:
+        Dict[str, str]: ratingKey -> slug
+    """
+    if not rating_keys:
+        return {}
+
+    values = " ".join(json.dumps(str(key)) for key in set(rating_keys))
+    result = run_query("movies_by_rating_key", values)
+
+    return {
+        b["rating_key"]["value"]: b["movie"]["value"].rsplit("/", 1)[-1]
+        for b in result["results"]["bindings"]
+    }
+
+
+def upload_graph(data: str, name: str = "") -> UpdateResponse:
+    """
+    Upload graph to the store, replacing the existing graph.
 
     Args:
         data: str
@@ -129,33 +384,37 @@ def upload_graph(data: str, name: str = "") -> Dict:
             Leave empty for default graph.
 
     Returns:
-        Dict
+        UpdateResponse
     """
-    url = f"{base}/data"
-    if name:
-        # Add to another graph other than default
-        url = f"{url}?graph=http://plex-kg/{name}"
-
-    result = requests.put(
-        url,
-        data=data,
-        headers={**headers, "Content-Type": "text/turtle"},
-        auth=("admin", "admin"),
-        timeout=10,
-    )
-
-    return result
+    return get_store().upload_graph(data, name)
 
 
-def validate_graphs(graphs: Graph, identifiers: List[str]) -> (bool, str):
+def validate_graphs(
+    graphs: Graph,
+    identifiers: List[str],
+    inference: Optional[str] = "rdfs",
+    max_workers: Optional[int] = None,
+) -> (bool, str):
     """
-    Validate graphs with multiple
+    Validate graphs with multiple shape files.
+
+    Validation is sharded by shape target class: each shard only holds the
+    focus nodes of one shape plus their one-hop neighbourhood, and the shards
+    are validated in a process pool. The reports are merged back into a
+    single validation report.
 
     Args:
         graphs: Graph
             Concatenated graphs.
         identifiers: List[str]
             Identifiers used to get shape file.
+        inference: Optional[str]
+            pyshacl inference option. Use None to skip inference when the
+            shapes don't rely on inferred triples.
+        max_workers: Optional[int]
+            Size of the process pool. Defaults to the number of CPUs. The
+            graph is validated in a single pass in this process when only
+            one worker or one shard is available.
 
     Returns:
         (bool, str)
@@ -165,14 +424,227 @@ def validate_graphs(graphs: Graph, identifiers: List[str]) -> (bool, str):
         shape_file = f"/app/rdf/shapes/{gi}.ttl"
         shape_graph = shape_graph + Graph().parse(shape_file, format="turtle")
 
+    targets = []
+    for shape, classes in _shape_targets(shape_graph).items():
+        focus_nodes = _focus_nodes(graphs, classes)
+        if focus_nodes:
+            targets.append((shape, focus_nodes))
+
+    workers = min(max_workers or os.cpu_count() or 1, len(targets))
+    if workers <= 1:
+        # sharding only pays off when the shards run in parallel
+        conforms, report_graph = _validate(graphs, shape_graph, inference)
+        return conforms, report_graph.serialize(format="turtle")
+
+    shards = [
+        (
+            _shard_graph(graphs, focus_nodes).serialize(format="nt"),
+            _shard_shapes(shape_graph, shape).serialize(format="turtle"),
+            inference,
+        )
+        for shape, focus_nodes in targets
+    ]
+    # Forking a process with running threads (uvicorn's threadpool, the
+    # store) can deadlock the child on a lock that was held at the fork.
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        reports = list(pool.map(_validate_shard, shards))
+
+    conforms = all(shard_conforms for shard_conforms, _ in reports)
+    report_graph = _merge_reports(
+        [Graph().parse(data=report, format="nt") for _, report in reports]
+    )
+
+    return conforms, report_graph.serialize(format="turtle")
+
+
+def _shape_targets(shape_graph: Graph) -> Dict:
+    """
+    Map every node shape to the classes it targets.
+
+    Args:
+        shape_graph: Graph
+
+    Returns:
+        Dict: shape -> list of target classes
+    """
+    targets = {}
+    for shape, target_class in shape_graph.subject_objects(SH.targetClass):
+        targets.setdefault(shape, []).append(target_class)
+
+    return targets
+
+
+def _focus_nodes(data_graph: Graph, classes: List) -> set:
+    """
+    Get instances of the target classes, including instances of their
+    subclasses.
+
+    Args:
+        data_graph: Graph
+        classes: List
+
+    Returns:
+        set
+    """
+    focus_nodes = set()
+    for target_class in classes:
+        subclasses = data_graph.transitive_subjects(
+            RDFS.subClassOf, target_class
+        )
+        for cls in subclasses:
+            focus_nodes.update(data_graph.subjects(RDF.type, cls))
+
+    return focus_nodes
+
+
+def _shard_graph(data_graph: Graph, focus_nodes: set) -> Graph:
+    """
+    Build a shard holding the focus nodes and their one-hop neighbourhood.
+    IRI neighbours only bring their rdf:type, which is all sh:class needs.
+    Blank node neighbours (eg. ratings checked with sh:node) are copied in
+    full, following nested blank nodes.
+
+    Args:
+        data_graph: Graph
+        focus_nodes: set
+
+    Returns:
+        Graph
+    """
+    shard = Graph()
+    neighbours = set()
+    for node in focus_nodes:
+        for triple in data_graph.triples((node, None, None)):
+            shard.add(triple)
+            if not isinstance(triple[2], Literal):
+                neighbours.add(triple[2])
+
+    blank_nodes = []
+    for node in neighbours - focus_nodes:
+        if isinstance(node, BNode):
+            blank_nodes.append(node)
+            continue
+        for triple in data_graph.triples((node, RDF.type, None)):
+            shard.add(triple)
+
+    seen = set(blank_nodes)
+    while blank_nodes:
+        node = blank_nodes.pop()
+        for triple in data_graph.triples((node, None, None)):
+            shard.add(triple)
+            if isinstance(triple[2], BNode) and triple[2] not in seen:
+                seen.add(triple[2])
+                blank_nodes.append(triple[2])
+
+    # class hierarchy is needed for sh:class and sh:targetClass checks
+    for triple in data_graph.triples((None, RDFS.subClassOf, None)):
+        shard.add(triple)
+
+    return shard
+
+
+def _shard_shapes(shape_graph: Graph, shape) -> Graph:
+    """
+    Copy the shapes graph keeping only the targets of a single shape.
+    Other shapes stay available for sh:node references.
+
+    Args:
+        shape_graph: Graph
+        shape: Node
+
+    Returns:
+        Graph
+    """
+    shard_shapes = Graph()
+    for s, p, o in shape_graph:
+        if p == SH.targetClass and s != shape:
+            continue
+        shard_shapes.add((s, p, o))
+
+    return shard_shapes
+
+
+def _validate_shard(shard: tuple) -> (bool, str):
+    """
+    Process pool worker. Graphs are passed as strings since they are
+    cheaper to pickle than rdflib graphs.
+
+    Args:
+        shard: tuple
+            (data as n-triples, shapes as turtle, inference)
+
+    Returns:
+        (bool, str): conforms and report as n-triples.
+    """
+    data, shapes, inference = shard
+    conforms, report_graph = _validate(
+        Graph().parse(data=data, format="nt"),
+        Graph().parse(data=shapes, format="turtle"),
+        inference,
+    )
+
+    return conforms, report_graph.serialize(format="nt")
+
+
+def _validate(
+    data_graph: Graph, shacl_graph: Graph, inference: Optional[str]
+) -> (bool, Graph):
+    """
+    Validate a data graph against a shapes graph.
+
+    Args:
+        data_graph: Graph
+        shacl_graph: Graph
+        inference: Optional[str]
+
+    Returns:
+        (bool, Graph)
+    """
     conforms, report_graph, report_text = validate(
-        data_graph=graphs,
-        shacl_graph=shape_graph,
-        inference="rdfs",
+        data_graph=data_graph,
+        shacl_graph=shacl_graph,
+        inference=inference,
         abort_on_first=False,
         meta_shacl=False,
         advanced=True,
         debug=False,
     )
 
-    return conforms, report_graph.serialize(format="turtle")
+    return conforms, report_graph
+
+
+def _merge_reports(report_graphs: List[Graph]) -> Graph:
+    """
+    Merge shard validation reports into a single sh:ValidationReport.
+
+    Args:
+        report_graphs: List[Graph]
+
+    Returns:
+        Graph
+    """
+    merged = Graph()
+    merged.bind("sh", SH)
+    report = BNode()
+    conforms = True
+
+    for report_graph in report_graphs:
+        shard_reports = report_graph.subjects(RDF.type, SH.ValidationReport)
+        for shard_report in shard_reports:
+            conforms = conforms and bool(
+                report_graph.value(shard_report, SH.conforms).toPython()
+            )
+            for result in report_graph.objects(shard_report, SH.result):
+                merged.add((report, SH.result, result))
+
+        for s, p, o in report_graph:
+            if (s, RDF.type, SH.ValidationReport) in report_graph:
+                continue
+            merged.add((s, p, o))
+
+    merged.add((report, RDF.type, SH.ValidationReport))
+    merged.add((report, SH.conforms, Literal(conforms, datatype=XSD.boolean)))
+
+    return merged
@@ -1,9 +1,62 @@
+import asyncio
 import json
 import os
 import re
 import requests
+import time
 import pandas as pd
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional
+
+
+class AdaptiveRateLimiter:
+    """
+    Spaces out request starts and backs off when Plex pushes back.
+
+    The interval between requests doubles when a request gets throttled
+    and shrinks again while requests succeed.
+
+    Attributes:
+        interval: float
+            Seconds between request starts.
+        min_interval: float
+        max_interval: float
+    """
+
+    def __init__(self, min_interval: float = 0.0, max_interval: float = 10.0):
+        self.interval = min_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        """
+        Wait for the next request slot.
+        """
+        async with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def throttled(self, retry_after: Optional[float] = None) -> None:
+        """
+        Args:
+            retry_after: Optional[float]
+                Seconds from the Retry-After header, if Plex sent one.
+        """
+        self.interval = min(self.max_interval, max(self.interval * 2, 0.1))
+        if retry_after:
+            self._next_start = max(
+                self._next_start, time.monotonic() + retry_after
+            )
+
+    def succeeded(self) -> None:
+        self.interval = max(self.min_interval, self.interval * 0.9)
+        if self.interval < 0.01:
+            self.interval = self.min_interval
 
 
 class PlexClient:
@@ -24,6 +77,9 @@ class PlexClient:
         base: str
             Plex server URL
         headers: Dict
+        metadata_cache_path: str
+            JSON file with the full tags of items that were already
+            enriched.
     """
 
     def __init__(self):
@@ -40,6 +96,11 @@ class PlexClient:
             "X-Plex-Product": "plex-kg",
             "X-Plex-Version": "0.1",
         }
+        # env files can set the variable to an empty string
+        self.metadata_cache_path = (
+            os.getenv("PLEX_METADATA_CACHE")
+            or "/app/data/cache/plex_metadata.json"
+        )
 
     @property
     def properties(self) -> List[str]:
@@ -48,6 +109,7 @@ class PlexClient:
             List[str]: List of properties for graph
         """
         return [
+            "ratingKey",
             "slug",
             "type",
             "title",
@@ -83,7 +145,9 @@ class PlexClient:
             tuple(genres, persons, media_data, history)
         """
         section_data = self._get_section_items(section_id)
-        section_metadata = section_data["MediaContainer"]["Metadata"]
+        section_metadata = self._enrich_items(
+            section_data["MediaContainer"]["Metadata"]
+        )
 
         structured_df = pd.DataFrame(
             [
@@ -114,14 +178,71 @@ class PlexClient:
         )
 
         history_data = self._get_playback_history(section_id, account_id)
-        history_df = pd.DataFrame(history_data["MediaContainer"]["Metadata"])
-        # Add the slugs to the history df
-        history_df = history_df.merge(
-            structured_df[["title", "slug"]], on="title", how="left"
+        # Add the slugs to the history df. Titles aren't unique so join on
+        # the ratingKey instead.
+        slug_map = dict(
+            zip(structured_df["ratingKey"].astype(str), structured_df["slug"])
+        )
+        history_df = self.map_history_slugs(
+            history_data["MediaContainer"].get("Metadata", []), slug_map
         )
 
         return genre_df, person_df, structured_df, history_df
 
+    def get_history_since(
+        self, section_id: int, account_id: int, viewed_after: int
+    ) -> List[Dict]:
+        """
+        Get playback history newer than a viewedAt watermark.
+
+        History is append-only, so only the plays after the watermark need
+        to be fetched. Pages are requested oldest first.
+
+        Args:
+            section_id: int
+            account_id: int
+            viewed_after: int
+                Unix timestamp. Plays at or before it are skipped.
+
+        Returns:
+            List[Dict]: history items.
+        """
+        return [
+            item
+            for item in self._get_playback_history_pages(
+                section_id, account_id, viewed_after
+            )
+            # Plex's viewedAt filter is inclusive
+            if item["viewedAt"] > viewed_after
+        ]
+
+    def map_history_slugs(
+        self, history_items: List[Dict], slug_map: Dict[str, str]
+    ) -> pd.DataFrame:
+        """
+        Add movie slugs to history items using a ratingKey lookup, eg.
+        the items from get_history_since. Plays of items that aren't in
+        the lookup (eg. removed from the library) are dropped.
+
+        Args:
+            history_items: List[Dict]
+            slug_map: Dict[str, str]
+                ratingKey -> slug
+
+        Returns:
+            pd.DataFrame
+        """
+        records = []
+        for item in history_items:
+            slug = slug_map.get(str(item.get("ratingKey")))
+            if slug is None:
+                continue
+            records.append({**item, "slug": slug})
+
+        return pd.DataFrame(
+            records, columns=["historyKey", "ratingKey", "viewedAt", "slug"]
+        )
+
     def _get(self, path: str) -> Dict:
         """
         HTTP GET request template.
@@ -153,6 +274,238 @@ class PlexClient:
             f"/status/sessions/history/all?librarySectionID={section_id}&accountID={account_id}"
         )
 
+    @property
+    def tag_properties(self) -> List[str]:
+        """
+        Returns:
+            List[str]: Properties that are truncated in section listings.
+        """
+        return ["Genre", "Director", "Writer", "Role"]
+
+    def _enrich_items(
+        self,
+        items: List[Dict],
+        batch_size: int = 20,
+        max_workers: int = 8,
+    ) -> List[Dict]:
+        """
+        Replace the truncated tag lists of section items with the full ones
+        from their metadata.
+
+        Only items whose updatedAt changed since the last run are fetched,
+        the others come from the metadata cache. Items that couldn't be
+        fetched keep their listing tags and are retried on the next run.
+
+        Args:
+            items: List[Dict]
+                Items from a section listing.
+            batch_size: int
+                ratingKeys per metadata request.
+            max_workers: int
+                Metadata requests in flight at the same time.
+
+        Returns:
+            List[Dict]
+        """
+        cache = self._load_metadata_cache()
+
+        stale_keys = [
+            str(item["ratingKey"])
+            for item in items
+            if cache.get(str(item["ratingKey"]), {}).get("updatedAt")
+            != item.get("updatedAt")
+        ]
+        if stale_keys:
+            fetched = asyncio.run(
+                self._fetch_metadata(stale_keys, batch_size, max_workers)
+            )
+            for metadata in fetched:
+                cache[str(metadata["ratingKey"])] = {
+                    "updatedAt": metadata.get("updatedAt"),
+                    **{t: metadata.get(t, []) for t in self.tag_properties},
+                }
+            self._save_metadata_cache(cache)
+
+        enriched = []
+        for item in items:
+            cached = cache.get(str(item["ratingKey"]))
+            if cached and cached["updatedAt"] == item.get("updatedAt"):
+                item = {
+                    **item,
+                    **{t: cached[t] for t in self.tag_properties},
+                }
+            enriched.append(item)
+
+        return enriched
+
+    async def _fetch_metadata(
+        self, rating_keys: List[str], batch_size: int, max_workers: int
+    ) -> List[Dict]:
+        """
+        Fetch full metadata with a bounded pool of async workers.
+
+        Args:
+            rating_keys: List[str]
+            batch_size: int
+            max_workers: int
+
+        Returns:
+            List[Dict]: metadata items.
+        """
+        queue = asyncio.Queue()
+        for i in range(0, len(rating_keys), batch_size):
+            queue.put_nowait(rating_keys[i : i + batch_size])
+
+        limiter = AdaptiveRateLimiter()
+        results = []
+
+        async def worker() -> None:
+            while not queue.empty():
+                batch = queue.get_nowait()
+                metadata = await self._fetch_metadata_batch(batch, limiter)
+                results.extend(metadata)
+
+        await asyncio.gather(
+            *(worker() for _ in range(min(max_workers, queue.qsize())))
+        )
+
+        return results
+
+    async def _fetch_metadata_batch(
+        self,
+        rating_keys: List[str],
+        limiter: AdaptiveRateLimiter,
+        retries: int = 5,
+    ) -> List[Dict]:
+        """
+        Fetch metadata for several items in one request. Plex accepts
+        comma separated ratingKeys.
+
+        Args:
+            rating_keys: List[str]
+            limiter: AdaptiveRateLimiter
+            retries: int
+
+        Returns:
+            List[Dict]: metadata items, without the items that couldn't be
+            fetched.
+        """
+        path = f"/library/metadata/{','.join(rating_keys)}"
+
+        for _ in range(retries):
+            await limiter.wait()
+            try:
+                # requests is blocking so it runs in a thread
+                result = await asyncio.to_thread(self._get, path)
+            except requests.HTTPError as e:
+                status_code = e.response.status_code
+                if status_code in (401, 403):
+                    # every other request would fail the same way
+                    raise
+                if status_code not in (429, 503):
+                    return await self._split_metadata_batch(
+                        rating_keys, limiter, retries
+                    )
+                retry_after = e.response.headers.get("Retry-After", "")
+                limiter.throttled(
+                    float(retry_after) if retry_after.isdigit() else None
+                )
+                continue
+            except (requests.ConnectionError, requests.Timeout):
+                limiter.throttled()
+                continue
+
+            limiter.succeeded()
+            return result["MediaContainer"].get("Metadata", [])
+
+        print(f"Couldn't fetch metadata for: {path}")
+        return []
+
+    async def _split_metadata_batch(
+        self,
+        rating_keys: List[str],
+        limiter: AdaptiveRateLimiter,
+        retries: int,
+    ) -> List[Dict]:
+        """
+        Fetch the halves of a batch that got an error response, eg. a 404
+        for a deleted item or a 414 for a long URL, so that only the items
+        that fail are left to fall back to their listing tags.
+
+        Args:
+            rating_keys: List[str]
+            limiter: AdaptiveRateLimiter
+            retries: int
+
+        Returns:
+            List[Dict]: metadata items.
+        """
+        if len(rating_keys) == 1:
+            print(f"Couldn't fetch metadata for: {rating_keys[0]}")
+            return []
+
+        middle = len(rating_keys) // 2
+        first = await self._fetch_metadata_batch(
+            rating_keys[:middle], limiter, retries
+        )
+        second = await self._fetch_metadata_batch(
+            rating_keys[middle:], limiter, retries
+        )
+
+        return first + second
+
+    def _load_metadata_cache(self) -> Dict:
+        if not os.path.exists(self.metadata_cache_path):
+            return {}
+
+        with open(self.metadata_cache_path) as f:
+            cache = json.load(f)
+        f.close()
+
+        return cache
+
+    def _save_metadata_cache(self, cache: Dict) -> None:
+        os.makedirs(os.path.dirname(self.metadata_cache_path), exist_ok=True)
+        with open(self.metadata_cache_path, "w") as f:
+            json.dump(cache, f)
+        f.close()
+
+    def _get_playback_history_pages(
+        self,
+        section_id: int,
+        account_id: int,
+        viewed_after: int = 0,
+        page_size: int = 500,
+    ) -> Iterator[Dict]:
+        """
+        Page through playback history items, oldest first.
+
+        Args:
+            section_id: int
+            account_id: int
+            viewed_after: int
+                Unix timestamp used for the viewedAt filter.
+            page_size: int
+
+        Yields:
+            Dict: history item.
+        """
+        start = 0
+        while True:
+            page = self._get(
+                "/status/sessions/history/all"
+                f"?librarySectionID={section_id}&accountID={account_id}"
+                f"&sort=viewedAt:asc&viewedAt>={viewed_after}"
+                f"&X-Plex-Container-Start={start}"
+                f"&X-Plex-Container-Size={page_size}"
+            )
+            items = page["MediaContainer"].get("Metadata", [])
+            yield from items
+
+            if len(items) < page_size:
+                break
+            start += page_size
+
     def _map_property_slugs(
         self, target_column: pd.DataFrame, property_unique_df: pd.DataFrame
     ):
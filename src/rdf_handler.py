@@ -3,6 +3,8 @@ from datetime import datetime, timezone
 from decimal import Decimal
 from rdflib import BNode, Graph, Literal, URIRef
 from rdflib.namespace import RDF, RDFS, SDO, XSD
+from typing import Dict
+from urllib.parse import urljoin
 
 base_uri = "http://plex-kg/"
 watcher_data = {"slug": "plex-watcher", "name": "Plex Watcher"}
@@ -63,6 +65,64 @@ class PlexRDFHandler:
 
         return self.g.serialize(format="turtle")
 
+    def movie_features(self) -> Dict[str, frozenset]:
+        """
+        Get the genres and persons of every movie in the graph, in the same
+        format as fuseki_helpers.get_movie_features.
+
+        Returns:
+            Dict[str, frozenset]: movie -> {(property, value)}
+        """
+        properties = [SDO.genre, SDO.director, SDO.author, SDO.actor]
+
+        return {
+            urljoin(base_uri, movie): frozenset(
+                (str(p), urljoin(base_uri, value))
+                for p in properties
+                for value in self.g.objects(movie, p)
+            )
+            for movie in self.g.subjects(RDF.type, SDO.Movie)
+        }
+
+    def watch_actions_to_update(self, history_data: pd.DataFrame) -> str:
+        """
+        Create a SPARQL update that only inserts new watch actions into the
+        default graph.
+
+        Args:
+            history_data: pd.DataFrame
+
+        Returns:
+            str: INSERT DATA update.
+        """
+        for _, watch_action in history_data.iterrows():
+            self._add_watch_action_entry(watch_action)
+
+        # URIs are relative to the graph base
+        triples = "\n".join(
+            f"    {s.n3()} {p.n3()} {o.n3()} ." for s, p, o in self.g
+        )
+
+        return f"BASE <{base_uri}>\n\nINSERT DATA {{\n{triples}\n}}"
+
+    def watch_stats_rows(self, history_data: pd.DataFrame) -> str:
+        """
+        Aggregate new plays per movie for the watch statistics update.
+
+        Args:
+            history_data: pd.DataFrame
+
+        Returns:
+            str: VALUES rows as (movie plays last_watch_date).
+        """
+        rows = []
+        for slug, plays in history_data.groupby("slug")["viewedAt"]:
+            movie = self._movie_uri(slug).n3()
+            last_watched = self._watch_date(plays.max()).n3()
+            rows.append(f"({movie} {len(plays)} {last_watched})")
+
+        return " ".join(rows)
+
     def _genre_uri(self, slug) -> str:
         return URIRef(f"genre/{slug}")
 
@@ -116,6 +176,7 @@ class PlexRDFHandler:
             )
 
         slug = movie_data["slug"]
+        rating_key = movie_data["ratingKey"]
         title = movie_data["title"]
         # contentRating = movie_data["contentRating"]
         rating = round(Decimal(movie_data["rating"]), 1)
@@ -132,6 +193,8 @@ class PlexRDFHandler:
 
         self.g.add((movie, RDF.type, SDO.Movie))
         self.g.add((movie, SDO.name, Literal(title, lang="en")))
+        # Plex ratingKey, used to join playback history to movies
+        self.g.add((movie, SDO.identifier, Literal(str(rating_key))))
         self.g.add(
             (
                 movie,
@@ -187,19 +250,25 @@ class PlexRDFHandler:
 
         history_slug = watch_action_data["historyKey"]
         movie_slug = watch_action_data["slug"]
-        viewed_at = datetime.fromtimestamp(
-            watch_action_data["viewedAt"], tz=timezone.utc
-        ).isoformat()
+        viewed_at = self._watch_date(watch_action_data["viewedAt"])
 
         watch_action = URIRef(f"history{history_slug}")
 
         self.g.add((watch_action, RDF.type, SDO.WatchAction))
         self.g.add((watch_action, SDO.agent, self._person_uri(watcher_slug)))
         self.g.add((watch_action, SDO.object, self._movie_uri(movie_slug)))
-        self.g.add(
-            (
-                watch_action,
-                SDO.startTime,
-                Literal(viewed_at, datatype=XSD.date),
-            )
+        self.g.add((watch_action, SDO.startTime, viewed_at))
+
+    def _watch_date(self, viewed_at: int) -> Literal:
+        """
+        Args:
+            viewed_at: int
+                Unix timestamp from Plex.
+
+        Returns:
+            Literal
+        """
+        return Literal(
+            datetime.fromtimestamp(viewed_at, tz=timezone.utc).isoformat(),
+            datatype=XSD.date,
         )
@@ -0,0 +1,289 @@
+import json
+import os
+import requests
+import threading
+from abc import ABC, abstractmethod
+from pyoxigraph import (
+    DefaultGraph,
+    NamedNode,
+    QueryResultsFormat,
+    RdfFormat,
+    Store,
+)
+from rdflib import Graph
+from typing import Dict, Optional, Union
+
+graph_base_uri = "http://plex-kg/"
+
+
+class StoreResponse:
+    """
+    Response for stores that don't go over HTTP. Mirrors the parts of
+    requests.Response that the routes use.
+
+    Attributes:
+        status_code: int
+        text: str
+    """
+
+    def __init__(self, status_code: int, text: str = ""):
+        self.status_code = status_code
+        self.text = text
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+
+# Fuseki returns the requests response as is
+UpdateResponse = Union[requests.Response, StoreResponse]
+
+
+class RDFStore(ABC):
+    """
+    Interface for the RDF store that holds the graphs.
+
+    Graphs are identified like in fuseki: an empty identifier is the
+    default graph, anything else is a named graph under http://plex-kg/.
+    """
+
+    @abstractmethod
+    def query(self, query: str) -> Dict:
+        """
+        Run SPARQL query.
+
+        Args:
+            query: str
+
+        Returns:
+            Dict: SPARQL JSON results.
+        """
+
+    @abstractmethod
+    def update(self, update: str) -> UpdateResponse:
+        """
+        Run SPARQL update.
+
+        Args:
+            update: str
+
+        Returns:
+            UpdateResponse
+        """
+
+    @abstractmethod
+    def get_graph(self, graph_identifier: str = "") -> Graph:
+        """
+        Download graph.
+
+        Args:
+            graph_identifier: str
+                Leave empty for the default graph.
+
+        Returns:
+            Graph
+        """
+
+    @abstractmethod
+    def upload_graph(self, data: str, name: str = "") -> UpdateResponse:
+        """
+        Replace graph with new data.
+
+        Args:
+            data: str
+                Graph as ttl string.
+            name: str
+                Leave empty for default graph.
+
+        Returns:
+            UpdateResponse
+        """
+
+
+class FusekiStore(RDFStore):
+    """
+    Fuseki over HTTP.
+
+    Attributes:
+        base: str
+            Fuseki dataset URL.
+        headers: Dict
+        auth: tuple
+    """
+
+    def __init__(self, base: Optional[str] = None):
+        self.base = (
+            base or os.getenv("FUSEKI_URL") or "http://fuseki:3030/plex"
+        )
+        self.headers = {
+            "Accept": "application/json",
+        }
+        self.auth = ("admin", "admin")
+
+    def query(self, query: str) -> Dict:
+        result = requests.post(
+            f"{self.base}/query",
+            data={"query": query},
+            headers=self.headers,
+            timeout=10,
+        )
+        result.raise_for_status()
+
+        return json.loads(result.text)
+
+    def update(self, update: str) -> requests.Response:
+        return requests.post(
+            f"{self.base}/update",
+            data=update,
+            headers={
+                **self.headers,
+                "Content-Type": "application/sparql-update",
+            },
+            auth=self.auth,
+            timeout=10,
+        )
+
+    def get_graph(self, graph_identifier: str = "") -> Graph:
+        if graph_identifier:
+            # Select graph other than default
+            graph_param = f"{graph_base_uri}{graph_identifier}"
+        else:
+            graph_param = "default"
+
+        result = requests.get(
+            f"{self.base}/data",
+            params={"graph": graph_param},
+            headers={**self.headers, "Accept": "text/turtle"},
+            auth=self.auth,
+        )
+        result.raise_for_status()
+
+        return Graph().parse(data=result.text, format="turtle")
+
+    def upload_graph(self, data: str, name: str = "") -> requests.Response:
+        url = f"{self.base}/data"
+        if name:
+            # Add to another graph other than default
+            url = f"{url}?graph={graph_base_uri}{name}"
+
+        return requests.put(
+            url,
+            data=data,
+            headers={**self.headers, "Content-Type": "text/turtle"},
+            auth=self.auth,
+            timeout=10,
+        )
+
+
+class EmbeddedStore(RDFStore):
+    """
+    Oxigraph store running in-process, so queries skip the network hop.
+    Also works as an offline stand-in for fuseki.
+
+    Only one process can open an on-disk store at a time.
+
+    Attributes:
+        store: pyoxigraph.Store
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Args:
+            path: Optional[str]
+                Directory of the on-disk store. Use None for an in-memory
+                store.
+        """
+        self.store = Store(path)
+
+    def query(self, query: str) -> Dict:
+        result = self.store.query(query)
+
+        return json.loads(result.serialize(format=QueryResultsFormat.JSON))
+
+    def update(self, update: str) -> StoreResponse:
+        try:
+            self.store.update(update)
+        except (SyntaxError, OSError) as e:
+            return StoreResponse(400, str(e))
+
+        return StoreResponse(204)
+
+    def get_graph(self, graph_identifier: str = "") -> Graph:
+        data = self.store.dump(
+            format=RdfFormat.TURTLE,
+            from_graph=self._graph_name(graph_identifier),
+        )
+
+        return Graph().parse(data=data, format="turtle")
+
+    def upload_graph(self, data: str, name: str = "") -> StoreResponse:
+        graph = self._graph_name(name)
+        try:
+            self.store.clear_graph(graph)
+            self.store.load(
+                input=data,
+                format=RdfFormat.TURTLE,
+                base_iri=graph_base_uri,
+                to_graph=graph,
+            )
+        except (SyntaxError, OSError) as e:
+            return StoreResponse(400, str(e))
+
+        count = sum(
+            1 for _ in self.store.quads_for_pattern(None, None, None, graph)
+        )
+        # same body as fuseki's graph store protocol
+        return StoreResponse(
+            200,
+            json.dumps({"count": count, "tripleCount": count, "quadCount": 0}),
+        )
+
+    def _graph_name(self, graph_identifier: str):
+        if graph_identifier:
+            return NamedNode(f"{graph_base_uri}{graph_identifier}")
+        return DefaultGraph()
+
+
+_store: Optional[RDFStore] = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> RDFStore:
+    """
+    Get the configured store. Set RDF_STORE to 'embedded' to use the
+    in-process store at RDF_STORE_PATH, fuseki is used otherwise.
+
+    Returns:
+        RDFStore
+    """
+    global _store
+    if _store is None:
+        # the first requests can arrive together, and an on-disk embedded
+        # store can only be opened once
+        with _store_lock:
+            if _store is None:
+                _store = _create_store()
+
+    return _store
+
+
+def _create_store() -> RDFStore:
+    if os.getenv("RDF_STORE", "fuseki") == "embedded":
+        # env files can set the variable to an empty string
+        return EmbeddedStore(
+            os.getenv("RDF_STORE_PATH") or "/app/data/embedded"
+        )
+
+    return FusekiStore()
+
+
+def set_store(store: RDFStore) -> None:
+    """
+    Replace the configured store, eg. with an in-memory EmbeddedStore.
+
+    Args:
+        store: RDFStore
+    """
+    global _store
+    with _store_lock:
+        _store = store
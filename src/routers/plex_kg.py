@@ -4,8 +4,18 @@ from fastapi import APIRouter, HTTPException
 from fastapi.responses import Response
 from fuseki_helpers import (
     construct_relationships,
+    drop_relationships,
     get_graph,
+    get_history_watermark,
+    get_movie_features,
+    get_movie_slugs,
+    ingest_watch_actions,
+    rebuild_watch_stats,
+    relations_exist,
     run_query,
+    run_recommendation,
+    set_history_watermark,
+    update_relationships,
     upload_graph,
     validate_graphs,
 )
@@ -18,54 +28,48 @@ router = APIRouter()
 
 @router.get("/fuseki/genres/most_watched")
 def most_watched_genres():
-    return run_query("genres_most_watched")
+    return run_query("genres_most_watched", coalesce=True)
 
 
 @router.get("/fuseki/movies/most_watched")
 def most_watched_movies():
-    return run_query("movies_most_watched")
+    return run_query("movies_most_watched", coalesce=True)
 
 
 @router.get("/fuseki/movies/last_watched")
 def last_watched_movies():
-    return run_query("movies_last_watched")
+    return run_query("movies_last_watched", coalesce=True)
 
 
 @router.get("/fuseki/movies/unwatched")
 def unwatched_movies():
-    return run_query("movies_unwatched")
+    return run_query("movies_unwatched", coalesce=True)
 
 
 @router.get("/fuseki/movies/filter/{movie_name}")
 def filter_movies_by_name(movie_name: str):
-    return run_query("movies_filter", movie_name)
+    return run_query("movies_filter", movie_name, coalesce=True)
 
 
 @router.get("/fuseki/movies/most_watched/recommend")
 def recommend_movies_based_on_most_watched_movie():
-    most_watched_movies = run_query("movies_most_watched")
-    top_watched = most_watched_movies["results"]["bindings"][0]["movie"][
-        "value"
-    ]
-    return run_query("recommend_unwatched_by_relation", top_watched)
+    return run_recommendation(
+        "recommend_unwatched_by_relation", "seed_most_watched"
+    )
 
 
 @router.get("/fuseki/movies/last_watched/recommend")
 def recommend_movies_based_on_last_watched_movie():
-    last_watched_movies = run_query("movies_last_watched")
-    last_watched = last_watched_movies["results"]["bindings"][0]["movie"][
-        "value"
-    ]
-    return run_query("recommend_unwatched_by_relation", last_watched)
+    return run_recommendation(
+        "recommend_unwatched_by_relation", "seed_last_watched"
+    )
 
 
 @router.get("/fuseki/movies/most_watched/recommend/rewatch")
 def recommend_rewatch():
-    most_watched_movies = run_query("movies_most_watched")
-    top_watched = most_watched_movies["results"]["bindings"][0]["movie"][
-        "value"
-    ]
-    return run_query("recommend_watched_by_relation", top_watched)
+    return run_recommendation(
+        "recommend_watched_by_relation", "seed_most_watched"
+    )
 
 
 @router.get("/fuseki/data/add")
@@ -106,12 +110,61 @@ def add_data(section_id: int, account_id: int) -> Dict:
             status_code=500, detail=f"{e}. Check console log for details."
         )
 
-    # Add main graph
-    data_add_response = upload_graph(turtle_data)
-    if not data_add_response.ok:
+    # Features before the upload, to find the movies with changed relations
+    previous_features = get_movie_features() if relations_exist() else None
+
+    # The relations are updated against the default graph right after it
+    # is replaced. If anything fails in between, the relations are dropped
+    # so the next run rebuilds them in full instead of finding no changes.
+    try:
+        # Add main graph
+        data_add_response = upload_graph(turtle_data)
+        if not data_add_response.ok:
+            raise HTTPException(
+                status_code=data_add_response.status_code,
+                detail=data_add_response.text,
+            )
+
+        # Add relationships graph... made by SPARQL query and not python
+        # logic. Only movies that were added, removed or changed need new
+        # relations, the full rebuild is for when there are no relations yet.
+        if previous_features is None:
+            relations_response = construct_relationships()
+        else:
+            current_features = rdf_handler.movie_features()
+            changed_movies = [
+                movie
+                for movie in previous_features.keys() | current_features.keys()
+                if previous_features.get(movie) != current_features.get(movie)
+            ]
+            relations_response = update_relationships(changed_movies)
+
+        if relations_response.status_code != 204:
+            raise HTTPException(
+                status_code=relations_response.status_code,
+                detail=relations_response.text,
+            )
+    except Exception:
+        drop_relationships()
+        raise
+
+    # Precompute watch statistics for the read routes
+    stats_response = rebuild_watch_stats()
+    if not stats_response.ok:
         raise HTTPException(
-            status_code=data_add_response.status_code,
-            detail=data_add_response.text,
+            status_code=stats_response.status_code,
+            detail=stats_response.text,
+        )
+
+    # The default graph was replaced, so the full history is in it now.
+    watermark = int(history_df["viewedAt"].max()) if len(history_df) else 0
+    watermark_response = set_history_watermark(
+        section_id, account_id, watermark
+    )
+    if not watermark_response.ok:
+        raise HTTPException(
+            status_code=watermark_response.status_code,
+            detail=watermark_response.text,
         )
 
     # Add ontology graph
@@ -125,19 +178,14 @@ def add_data(section_id: int, account_id: int) -> Dict:
             detail=ont_add_response.text,
         )
 
-    # Add relationships graph... made by SPARQL query and not python logic.
-    relations_response = construct_relationships()
-    if relations_response.status_code != 204:
-        raise HTTPException(
-            status_code=relations_response.status_code,
-            detail=relations_response.text,
-        )
-
     # Concat main and relationships graph for easier validation.
     default_graph = get_graph()
     relations_graph = get_graph("relations")
     graphs = default_graph + relations_graph
-    conforms, report_graph = validate_graphs(graphs, ["default", "relations"])
+    # The shapes only check asserted types, so RDFS inference is skipped.
+    conforms, report_graph = validate_graphs(
+        graphs, ["default", "relations"], inference=None
+    )
     if not conforms:
         return Response(
             status_code=400,
@@ -153,3 +201,58 @@ def add_data(section_id: int, account_id: int) -> Dict:
         "data": json.loads(data_add_response.text),
         "relationships": "Successfully built.",
     }
+
+
+@router.get("/fuseki/data/history/sync")
+def sync_history(section_id: int, account_id: int) -> Dict:
+    """
+    Add plays newer than the stored viewedAt watermark to fuseki.
+
+    Only the new watch actions are inserted so a sync is proportional to
+    the number of new plays, not the whole watch history. Run
+    '/fuseki/data/add' first so that the movies exist.
+
+    Args:
+        section_id: int
+        account_id: int
+
+    Returns:
+        Dict
+
+    Raises:
+        HTTPException:
+            If the update fails.
+    """
+    watermark = get_history_watermark(section_id, account_id)
+
+    pc = PlexClient()
+    history_items = pc.get_history_since(section_id, account_id, watermark)
+    if not history_items:
+        return {"added": 0, "watermark": watermark}
+
+    slug_map = get_movie_slugs([item["ratingKey"] for item in history_items])
+    history_df = pc.map_history_slugs(history_items, slug_map)
+
+    # Plays of unknown movies are skipped, the watermark still moves past
+    # them so they aren't fetched again.
+    watermark = max(item["viewedAt"] for item in history_items)
+
+    if len(history_df):
+        rdf_handler = PlexRDFHandler()
+        response = ingest_watch_actions(
+            rdf_handler.watch_actions_to_update(history_df),
+            rdf_handler.watch_stats_rows(history_df),
+            section_id,
+            account_id,
+            watermark,
+        )
+    else:
+        response = set_history_watermark(section_id, account_id, watermark)
+
+    if not response.ok:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=response.text,
+        )
+
+    return {"added": len(history_df), "watermark": watermark}